@@ -0,0 +1,1091 @@
+"""
+Segment rule engine: user validation, rule parsing/compilation and evaluation.
+Kept free of Flask so it can be compiled with mypyc or run under PyPy.
+"""
+import time
+import os
+import re
+import ast
+import operator
+import platform
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from enum import IntEnum
+from functools import lru_cache, partial
+from typing import Any, Callable, ClassVar, Optional, Union
+
+import numpy as np
+
+# Valid user document fields
+VALID_FIELDS = {
+    'id', 'level', 'country', 'first_session', 
+    'last_session', 'purchase_amount', 'last_purchase_at'
+}
+
+STRING_FIELDS = {'id', 'country'}
+NUMERIC_FIELDS = {'level', 'first_session', 'last_session', 'purchase_amount', 'last_purchase_at'}
+
+# Required fields in document order, paired with whether each is a string field
+REQUIRED_FIELDS = ('id', 'level', 'country', 'first_session',
+                   'last_session', 'purchase_amount', 'last_purchase_at')
+_FIELD_KINDS = tuple((field, field in STRING_FIELDS) for field in REQUIRED_FIELDS)
+_MISSING = object()
+
+# Precompiled rule patterns
+_RE_NOW = re.compile(r'_now\(\)')
+_RE_STRLIT = re.compile(r"'[^']*'")
+_RE_NUM = re.compile(r'\b\d+\b')
+_RE_KEYWORDS = re.compile(r'\b(?:and|or|not|in|between|like)\b', re.IGNORECASE)
+_RE_OPS = re.compile(r'[<>=!()*/+\-,]')
+_RE_TOKEN = re.compile(r"""\s*(?:
+    (?P<NUMBER>\d+)
+  | (?P<NOW>_now\s*\(\s*\))
+  | (?P<NAME>[A-Za-z_]\w*)
+  | (?P<STRING>'[^']*'|"[^"]*")
+  | (?P<OP><=|>=|!=|<>|//|[=<>+\-*/(),])
+)""", re.VERBOSE)
+
+# Single-predicate rule shapes that skip the parser entirely
+_RE_CMP_ONLY = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|<>|=|<|>)\s*(-?(?:0|[1-9]\d*))\s*$')
+_RE_BETWEEN_ONLY = re.compile(r'^\s*(\w+)\s+between\s+(-?(?:0|[1-9]\d*))\s+and\s+(-?(?:0|[1-9]\d*))\s*$',
+                              re.IGNORECASE)
+_RE_IN_ONLY = re.compile(r"^\s*(\w+)\s+in\s*\(((?:\s*(?:'[^']*'|[-+]?\d+)\s*,)*\s*(?:'[^']*'|[-+]?\d+)\s*)\)\s*$",
+                         re.IGNORECASE)
+_RE_IN_VALUE = re.compile(r"'([^']*)'|([-+]?\d+)")
+
+SQL_KEYWORDS = {'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'LIKE'}
+COMPARISON_OPERATORS = {'=', '!=', '<>', '<', '>', '<=', '>='}
+
+# Column batches with at least this many segments evaluate them in parallel
+PARALLEL_SEGMENTS = 8
+_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Error payloads for malformed requests; the server serializes them once
+INVALID_JSON = {"error": "Invalid JSON"}
+MISSING_USER = {"error": "Missing 'user' field"}
+MISSING_SEGMENTS = {"error": "Missing 'segments' field"}
+STATIC_ERRORS = (INVALID_JSON, MISSING_USER, MISSING_SEGMENTS)
+
+# Timestamp of the request being evaluated, read by _now()
+_REQUEST_NOW: ContextVar[Optional[int]] = ContextVar('request_now', default=None)
+
+# Evaluate rules on the bytecode VM rather than generated closures.
+# Closures are faster on CPython; the VM loop pays off under PyPy.
+RULE_VM = os.environ.get('RULE_VM', str(int(platform.python_implementation() == 'PyPy'))) == '1'
+
+
+def validate_user_document(user: dict[str, Any]) -> bool:
+    """
+    Validate user document according to spec:
+    - All required fields present
+    - No null values
+    - Numeric fields are non-negative integers
+    - String fields are not empty
+    """
+    if not isinstance(user, dict):
+        # A list or scalar holds none of the fields
+        raise ValueError(f"Missing required field: {_FIELD_KINDS[0][0]}")
+    
+    for field, is_string in _FIELD_KINDS:
+        value = user.get(field, _MISSING)
+        if value is _MISSING:
+            raise ValueError(f"Missing required field: {field}")
+        
+        if is_string:
+            if type(value) is not str:
+                if value is None:
+                    raise ValueError(f"Field '{field}' cannot be null")
+                raise ValueError(f"Field '{field}' must be a string")
+            if not value:
+                raise ValueError(f"Field '{field}' cannot be empty")
+        elif type(value) is not int:
+            if value is None:
+                raise ValueError(f"Field '{field}' cannot be null")
+            raise ValueError(f"Field '{field}' must be an integer")
+        elif value < 0:
+            raise ValueError(f"Field '{field}' must be non-negative")
+    
+    # Extra fields are allowed, but not as nulls
+    if len(user) > len(_FIELD_KINDS):
+        for field, value in user.items():
+            if value is None:
+                raise ValueError(f"Field '{field}' cannot be null")
+    
+    return True
+
+
+def user_columns(users: dict[str, list]) -> dict[str, np.ndarray]:
+    """
+    Validate a column-oriented batch of users ({field: [values, ...]})
+    and convert it into one NumPy array per field.
+    """
+    if not isinstance(users, dict):
+        raise ValueError("Field 'users' must be an object of field columns")
+    
+    # Check all required fields present, and every column an equally long list
+    for field in REQUIRED_FIELDS:
+        if field not in users:
+            raise ValueError(f"Missing required field: {field}")
+    
+    names = list(users)
+    for name in names:
+        if not isinstance(users[name], list):
+            raise ValueError(f"Field '{name}' must be a list")
+    if len({len(users[name]) for name in names}) > 1:
+        raise ValueError("All user columns must have the same length")
+    
+    # Validate whole columns: the types present in each list, then the value
+    # checks on the converted arrays
+    columns = {}
+    for field, is_string in _FIELD_KINDS:
+        values = users[field]
+        if set(map(type, values)) - {str if is_string else int}:
+            if None in values:
+                raise ValueError(f"Field '{field}' cannot be null")
+            raise ValueError(f"Field '{field}' must be {'a string' if is_string else 'an integer'}")
+        
+        if is_string:
+            if '' in values:
+                raise ValueError(f"Field '{field}' cannot be empty")
+            columns[field] = np.array(values, dtype=str)
+        else:
+            try:
+                columns[field] = np.array(values, dtype=np.int64)
+            except OverflowError:
+                raise ValueError(f"Field '{field}' must be a 64-bit integer")
+            if (columns[field] < 0).any():
+                raise ValueError(f"Field '{field}' must be non-negative")
+    
+    # Extra fields are allowed, but not as nulls
+    for name in names:
+        if name not in columns and None in users[name]:
+            raise ValueError(f"Field '{name}' cannot be null")
+    
+    return columns
+
+
+def extract_fields_from_condition(condition: str) -> set[str]:
+    """
+    Extract field names from a SQL condition to validate they exist.
+    Returns set of field names found. compile_rule collects fields from
+    the parsed rule instead; this is kept for existing callers.
+    """
+    # Remove _now() function calls
+    temp_condition = _RE_NOW.sub('', condition)
+    
+    # Remove string literals (single quotes)
+    temp_condition = _RE_STRLIT.sub('', temp_condition)
+    
+    # Remove numbers
+    temp_condition = _RE_NUM.sub('', temp_condition)
+    
+    # Remove SQL keywords (case-insensitive)
+    temp_condition = _RE_KEYWORDS.sub('', temp_condition)
+    
+    # Remove operators and parentheses
+    temp_condition = _RE_OPS.sub(' ', temp_condition)
+    
+    # Split and filter to get potential field names
+    tokens = temp_condition.split()
+    fields = set()
+    
+    for token in tokens:
+        token = token.strip()
+        if token and token.isidentifier():
+            fields.add(token)
+    
+    return fields
+
+
+def validate_sql_syntax(condition: str) -> bool:
+    """
+    Basic SQL syntax validation.
+    Checks for common syntax errors in a single scan; string literals
+    are skipped.
+    """
+    depth = 0
+    quote = ''
+    empty = True
+    prev2 = prev = ''
+    for char in condition:
+        if quote:
+            if char == quote:
+                quote = ''
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced parentheses in SQL condition")
+        # Check for invalid operators: <<, ><, >>, <=<, <=>, ===, !== and the like
+        elif char in '<>':
+            if (prev in ('<', '>') and prev + char != '<>') or (prev == '=' and prev2 in ('<', '>')):
+                raise ValueError("Invalid SQL operator syntax")
+        elif char == '=' and prev == '=' and prev2 in ('=', '!'):
+            raise ValueError("Invalid SQL operator syntax")
+        
+        if not char.isspace():
+            empty = False
+        prev2, prev = prev, char
+    
+    # Check for balanced parentheses
+    if depth:
+        raise ValueError("Unbalanced parentheses in SQL condition")
+    
+    # Check for empty condition
+    if empty:
+        raise ValueError("Empty SQL condition")
+    
+    return True
+
+
+class Or:
+    """Logical OR of two or more child nodes"""
+    def __init__(self, children: list['Node']) -> None:
+        self.children = children
+
+    def fields(self) -> set[str]:
+        return set().union(*(child.fields() for child in self.children))
+
+    def key(self) -> tuple:
+        # Canonical form: operand order does not matter for AND/OR
+        return ('OR', frozenset(child.key() for child in self.children))
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return '(' + ' or '.join(child.emit(constants) for child in self.children) + ')'
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return '(' + ' | '.join(child.emit_columns(constants) for child in self.children) + ')'
+
+    def emit_program(self, program: 'Program') -> None:
+        _lower_short_circuit(program, self.children, Op.JUMP_IF_TRUE_OR_POP)
+
+
+class And:
+    """Logical AND of two or more child nodes"""
+    def __init__(self, children: list['Node']) -> None:
+        self.children = children
+
+    def fields(self) -> set[str]:
+        return set().union(*(child.fields() for child in self.children))
+
+    def key(self) -> tuple:
+        return ('AND', frozenset(child.key() for child in self.children))
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return '(' + ' and '.join(child.emit(constants) for child in self.children) + ')'
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return '(' + ' & '.join(child.emit_columns(constants) for child in self.children) + ')'
+
+    def emit_program(self, program: 'Program') -> None:
+        _lower_short_circuit(program, self.children, Op.JUMP_IF_FALSE_OR_POP)
+
+
+class Not:
+    """Logical negation of a child node"""
+    def __init__(self, child: 'Node') -> None:
+        self.child = child
+
+    def fields(self) -> set[str]:
+        return self.child.fields()
+
+    def key(self) -> tuple:
+        return ('NOT', self.child.key())
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return f"(not {self.child.emit(constants)})"
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return f"(~{self.child.emit_columns(constants)})"
+
+    def emit_program(self, program: 'Program') -> None:
+        self.child.emit_program(program)
+        program.append((Op.NOT,))
+
+
+class Cmp:
+    """field <op> value, where value is a string literal or arithmetic expression"""
+    OPERATORS = {'=': '==', '!=': '!=', '<>': '!=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+    FUNCTIONS: ClassVar[dict[str, Callable[[Any, Any], Any]]] = {
+        '=': operator.eq, '!=': operator.ne, '<>': operator.ne, '<': operator.lt,
+        '>': operator.gt, '<=': operator.le, '>=': operator.ge}
+
+    def __init__(self, field: str, operator: str, value: str) -> None:
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    def fields(self) -> set[str]:
+        return {self.field}
+
+    def key(self) -> tuple:
+        return ('CMP', self.field, self.OPERATORS[self.operator], self.value)
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return f"(u[{self.field!r}] {self.OPERATORS[self.operator]} {self.value})"
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return self.emit(constants)
+
+    def emit_program(self, program: 'Program') -> None:
+        program.append((Op.PUSH_FIELD, self.field))
+        _lower_value(program, self.value)
+        program.append((Op.COMPARE, self.FUNCTIONS[self.operator]))
+
+
+class Between:
+    """field BETWEEN lower AND upper (inclusive)"""
+    def __init__(self, field: str, lower: str, upper: str) -> None:
+        self.field = field
+        self.lower = lower
+        self.upper = upper
+
+    def fields(self) -> set[str]:
+        return {self.field}
+
+    def key(self) -> tuple:
+        return ('BETWEEN', self.field, self.lower, self.upper)
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return f"({self.lower} <= u[{self.field!r}] <= {self.upper})"
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return f"(({self.lower} <= u[{self.field!r}]) & (u[{self.field!r}] <= {self.upper}))"
+
+    def emit_program(self, program: 'Program') -> None:
+        program.append((Op.PUSH_FIELD, self.field))
+        _lower_value(program, self.lower)
+        _lower_value(program, self.upper)
+        program.append((Op.BETWEEN,))
+
+
+class In:
+    """field IN (value, ...)"""
+    def __init__(self, field: str, values: list) -> None:
+        self.field = field
+        self.values = values
+
+    def fields(self) -> set[str]:
+        return {self.field}
+
+    def key(self) -> tuple:
+        return ('IN', self.field, frozenset(self.values))
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        return f"(u[{self.field!r}] in {tuple(self.values)!r})"
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        return f"_isin(u[{self.field!r}], {list(self.values)!r})"
+
+    def emit_program(self, program: 'Program') -> None:
+        program.append((Op.PUSH_FIELD, self.field))
+        program.append((Op.IN, tuple(self.values)))
+
+
+class Like:
+    """field LIKE 'pattern' with SQL % and _ wildcards"""
+    def __init__(self, field: str, pattern: str) -> None:
+        self.field = field
+        self.pattern = pattern
+
+    def fields(self) -> set[str]:
+        return {self.field}
+
+    def key(self) -> tuple:
+        return ('LIKE', self.field, self.pattern)
+
+    def emit(self, constants: dict[str, Any]) -> str:
+        # The compiled regex is bound into the closure namespace as a constant
+        name = f"_k{len(constants)}"
+        constants[name] = _like_to_regex(self.pattern)
+        return f"({name}.match(str(u[{self.field!r}])) is not None)"
+
+    def emit_columns(self, constants: dict[str, Any]) -> str:
+        name = f"_k{len(constants)}"
+        match = _like_to_regex(self.pattern).match
+        constants[name] = np.vectorize(lambda value: match(str(value)) is not None, otypes=[bool])
+        return f"{name}(u[{self.field!r}])"
+
+    def emit_program(self, program: 'Program') -> None:
+        program.append((Op.PUSH_FIELD, self.field))
+        program.append((Op.LIKE, _like_to_regex(self.pattern)))
+
+
+Node = Union[Or, And, Not, Cmp, Between, In, Like]
+Token = tuple[str, str]
+
+
+def _now() -> int:
+    """
+    Current unix timestamp, resolved each time a compiled rule runs.
+    Inside evaluate_batch this is the request's timestamp, shared by all segments.
+    """
+    now = _REQUEST_NOW.get()
+    return int(time.time()) if now is None else now
+
+
+@lru_cache(maxsize=1024)
+def _like_to_regex(pattern: str) -> re.Pattern:
+    """Translate a SQL LIKE pattern into a compiled regex"""
+    return re.compile('^' + re.escape(pattern).replace('%', '.*').replace('_', '.') + '$')
+
+
+@lru_cache(maxsize=1024)
+def expression_source(expression: str) -> str:
+    """
+    Translate a numeric rule expression into Python source.
+    Constant parts are folded here, so only _now() is left for run time.
+    """
+    tree = _parse_expression(expression)
+    folded = _fold_expression(tree)
+    if not isinstance(folded, ast.AST):
+        return repr(int(folded))
+    
+    source = ast.unparse(folded)
+    # Any true division, even one folded into a float constant, makes the
+    # result truncate like int(eval(expression)) would
+    if any(isinstance(node, ast.Div) for node in ast.walk(tree)):
+        source = f"int({source})"
+    return source
+
+
+@lru_cache(maxsize=4096)
+def parse_rule(condition: str) -> 'Node':
+    """
+    Validate and parse a SQL WHERE condition into a tree of rule nodes.
+    Raises ValueError for invalid syntax or unknown fields.
+    """
+    # Validate SQL syntax
+    try:
+        validate_sql_syntax(condition)
+    except ValueError as e:
+        raise ValueError(f"Invalid SQL syntax: {str(e)}")
+    
+    # Parse the condition and validate the fields it references
+    tokens = _tokenize(condition)
+    tree, i = _parse_or(tokens, 0)
+    if tokens[i][0] != 'END':
+        raise _unexpected(tokens[i])
+    invalid_fields = tree.fields() - VALID_FIELDS
+    if invalid_fields:
+        raise ValueError(f"Unknown fields in segment rule: {', '.join(invalid_fields)}")
+    
+    return tree
+
+
+def _build_lambda(body: str, constants: dict[str, Any]) -> Callable[[Any], Any]:
+    """Compile emitted rule source into a lambda over a restricted namespace"""
+    code = compile('lambda u: ' + body, '<rule>', 'eval')
+    namespace = {'__builtins__': {}, 'int': int, 'str': str, '_now': _now, '_isin': np.isin, **constants}
+    return eval(code, namespace)
+
+
+@lru_cache(maxsize=4096)
+def compile_rule(condition: str) -> Callable[[dict[str, Any]], bool]:
+    """
+    Compile a SQL WHERE condition into a callable taking a user document.
+    The condition is validated and parsed once; _now() stays dynamic.
+    With RULE_VM enabled the callable runs the bytecode program instead
+    of the generated closure.
+    """
+    fast = _compile_simple_rule(condition)
+    if fast is not None:
+        return fast
+    
+    if RULE_VM:
+        return partial(execute_program, compile_program(condition))
+    
+    constants: dict[str, Any] = {}
+    return _build_lambda(parse_rule(condition).emit(constants), constants)
+
+
+def _compile_simple_rule(condition: str) -> Optional[Callable[[dict[str, Any]], bool]]:
+    """
+    Build a closure directly for single-predicate rules on a known field:
+    `field op number` (numeric fields), `field BETWEEN n AND m` and
+    `field IN (literal, ...)`. The node comes from the regex match instead
+    of the tokenizer and parser. Returns None for anything else.
+    """
+    node: Optional['Node'] = None
+    match = _RE_CMP_ONLY.match(condition)
+    if match:
+        field, op, value = match.groups()
+        if field in NUMERIC_FIELDS:
+            node = Cmp(field, op, str(int(value)))
+    
+    match = _RE_BETWEEN_ONLY.match(condition)
+    if match and match.group(1) in NUMERIC_FIELDS:
+        node = Between(match.group(1), str(int(match.group(2))), str(int(match.group(3))))
+    
+    match = _RE_IN_ONLY.match(condition)
+    if match and match.group(1) in VALID_FIELDS:
+        field = match.group(1)
+        values: list[Any] = [value.group(1) if value.group(2) is None else value.group(2)
+                             for value in _RE_IN_VALUE.finditer(match.group(2))]
+        if field in NUMERIC_FIELDS:
+            values = [int(v) for v in values]
+        node = In(field, values)
+    
+    if node is None:
+        return None
+    return _build_lambda(node.emit({}), {})
+
+
+@lru_cache(maxsize=4096)
+def compile_columns_rule(condition: str) -> Callable[[dict[str, np.ndarray]], np.ndarray]:
+    """
+    Compile a SQL WHERE condition into a callable taking a dict of NumPy
+    columns (one array per field) and returning a boolean array.
+    """
+    constants: dict[str, Any] = {}
+    return _build_lambda(parse_rule(condition).emit_columns(constants), constants)
+
+
+class Op(IntEnum):
+    """Opcodes of the rule VM; each instruction is a tuple (opcode, *args)"""
+    PUSH_FIELD = 1
+    PUSH_CONST = 2
+    PUSH_NOW = 3
+    ARITH = 4
+    UNARY = 5
+    COMPARE = 6
+    BETWEEN = 7
+    IN = 8
+    LIKE = 9
+    NOT = 10
+    JUMP_IF_FALSE_OR_POP = 11
+    JUMP_IF_TRUE_OR_POP = 12
+    CMP_FIELD_CONST = 13
+
+
+Program = list[tuple[Any, ...]]
+
+JUMP_OPCODES = {Op.JUMP_IF_FALSE_OR_POP, Op.JUMP_IF_TRUE_OR_POP}
+
+
+def _lower_short_circuit(program: 'Program', children: list['Node'], jump: Op) -> None:
+    """Lower AND/OR children, jumping past the rest once the result is known"""
+    jumps = []
+    for child in children[:-1]:
+        child.emit_program(program)
+        jumps.append(len(program))
+        program.append((jump, -1))
+    children[-1].emit_program(program)
+    for index in jumps:
+        program[index] = (jump, len(program))
+
+
+def _lower_value(program: 'Program', source: str) -> None:
+    """Lower a folded value expression; _now() becomes PUSH_NOW"""
+    _lower_arithmetic(program, ast.parse(source, mode='eval').body)
+
+
+def _lower_arithmetic(program: 'Program', node: ast.expr) -> None:
+    """Lower the AST of a folded expression into stack instructions"""
+    if isinstance(node, ast.Constant):
+        program.append((Op.PUSH_CONST, node.value))
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        # _now() or the int() truncation wrapped around a division
+        if node.func.id == '_now':
+            program.append((Op.PUSH_NOW,))
+        else:
+            _lower_arithmetic(program, node.args[0])
+            program.append((Op.UNARY, int))
+    elif isinstance(node, ast.BinOp):
+        _lower_arithmetic(program, node.left)
+        _lower_arithmetic(program, node.right)
+        program.append((Op.ARITH, BINARY_OPERATORS[type(node.op)]))
+    elif isinstance(node, ast.UnaryOp):
+        _lower_arithmetic(program, node.operand)
+        program.append((Op.UNARY, UNARY_OPERATORS[type(node.op)]))
+    else:
+        raise ValueError(f"Invalid expression: {ast.unparse(node)}")
+
+
+def _peephole(program: 'Program') -> 'Program':
+    """
+    Fuse PUSH_FIELD f; PUSH_CONST c; COMPARE op into a single
+    CMP_FIELD_CONST getter op c, with the field accessor pre-bound as an
+    itemgetter, and retarget jumps to the shortened program.
+    """
+    fused: Program = []
+    index = {}
+    k = 0
+    while k < len(program):
+        index[k] = len(fused)
+        instruction = program[k]
+        if (instruction[0] == Op.PUSH_FIELD and k + 2 < len(program)
+                and program[k + 1][0] == Op.PUSH_CONST and program[k + 2][0] == Op.COMPARE):
+            fused.append((Op.CMP_FIELD_CONST, operator.itemgetter(instruction[1]), program[k + 2][1],
+                          program[k + 1][1]))
+            k += 3
+        else:
+            fused.append(instruction)
+            k += 1
+    index[len(program)] = len(fused)
+    return [(ins[0], index[ins[1]]) if ins[0] in JUMP_OPCODES else ins for ins in fused]
+
+
+@lru_cache(maxsize=4096)
+def compile_program(condition: str) -> 'Program':
+    """Compile a SQL WHERE condition into a list of VM instructions"""
+    program: Program = []
+    parse_rule(condition).emit_program(program)
+    return _peephole(program)
+
+
+def execute_program(program: 'Program', user: dict[str, Any]) -> bool:
+    """Run a compiled rule program against a user document"""
+    stack: list[Any] = []
+    push = stack.append
+    pop = stack.pop
+    now = None
+    pc = 0
+    end = len(program)
+    while pc < end:
+        instruction = program[pc]
+        opcode = instruction[0]
+        pc += 1
+        if opcode == Op.CMP_FIELD_CONST:
+            push(instruction[2](instruction[1](user), instruction[3]))
+        elif opcode == Op.PUSH_FIELD:
+            push(user[instruction[1]])
+        elif opcode == Op.PUSH_CONST:
+            push(instruction[1])
+        elif opcode == Op.PUSH_NOW:
+            # Read the clock once per execution
+            if now is None:
+                now = _now()
+            push(now)
+        elif opcode == Op.JUMP_IF_FALSE_OR_POP:
+            if not stack[-1]:
+                pc = instruction[1]
+            else:
+                pop()
+        elif opcode == Op.JUMP_IF_TRUE_OR_POP:
+            if stack[-1]:
+                pc = instruction[1]
+            else:
+                pop()
+        elif opcode == Op.NOT:
+            push(not pop())
+        elif opcode == Op.IN:
+            push(pop() in instruction[1])
+        elif opcode == Op.LIKE:
+            push(instruction[1].match(str(pop())) is not None)
+        elif opcode == Op.BETWEEN:
+            upper = pop()
+            lower = pop()
+            push(lower <= pop() <= upper)
+        elif opcode == Op.COMPARE:
+            right = pop()
+            push(instruction[1](pop(), right))
+        elif opcode == Op.ARITH:
+            right = pop()
+            push(instruction[1](pop(), right))
+        elif opcode == Op.UNARY:
+            push(instruction[1](pop()))
+    return stack[-1]
+
+
+def _count_keys(node: 'Node', counts: dict[tuple, int]) -> None:
+    """
+    Count the occurrences of each node's canonical key. The children of a
+    repeated node are counted once, as they are only evaluated inside it.
+    """
+    key = node.key()
+    counts[key] = counts.get(key, 0) + 1
+    if counts[key] > 1:
+        return
+    if isinstance(node, (And, Or)):
+        for child in node.children:
+            _count_keys(child, counts)
+    elif isinstance(node, Not):
+        _count_keys(node.child, counts)
+
+
+def _emit_shared(node: 'Node', constants: dict[str, Any], shared: dict[tuple, Optional[str]],
+                 bindings: list[str]) -> str:
+    """
+    Emit a rule tree's source, replacing repeated subexpressions with the
+    local they are bound to. A binding is added on the first occurrence,
+    after the bindings of any repeated subexpressions inside it.
+    """
+    key = node.key()
+    if shared.get(key):
+        return str(shared[key])
+    
+    if isinstance(node, (And, Or)):
+        joiner = ' and ' if isinstance(node, And) else ' or '
+        source = '(' + joiner.join(_emit_shared(child, constants, shared, bindings)
+                                   for child in node.children) + ')'
+    elif isinstance(node, Not):
+        source = f"(not {_emit_shared(node.child, constants, shared, bindings)})"
+    else:
+        source = node.emit(constants)
+    
+    if key in shared:
+        name = f"_s{len(bindings)}"
+        bindings.append(f"({name} := {source})")
+        shared[key] = name
+        return name
+    return source
+
+
+@lru_cache(maxsize=1024)
+def compile_segments(conditions: tuple[str, ...]) -> Optional[Callable[[dict[str, Any]], tuple]]:
+    """
+    Compile a tuple of conditions into one closure returning each
+    condition's result. Subexpressions repeated across the conditions are
+    evaluated once per user and bound to locals; AND/OR around them still
+    short-circuit. Returns None when the conditions share nothing.
+    Like the parser's closures, this ignores RULE_VM and the
+    single-predicate fast path.
+    """
+    trees = [parse_rule(condition) for condition in conditions]
+    counts: dict[tuple, int] = {}
+    for tree in trees:
+        _count_keys(tree, counts)
+    shared: dict[tuple, Optional[str]] = {key: None for key, count in counts.items() if count > 1}
+    if not shared:
+        return None
+    
+    constants: dict[str, Any] = {}
+    bindings: list[str] = []
+    roots = [_emit_shared(tree, constants, shared, bindings) for tree in trees]
+    # The bindings run first, in order, then the results are returned
+    return _build_lambda('(' + ', '.join(bindings + ['(' + ', '.join(roots) + ',)']) + ')[-1]',
+                         constants)
+
+
+def evaluate_condition(user: dict[str, Any], condition: str) -> bool:
+    """
+    Evaluate a SQL WHERE condition against user data.
+    Supports all common ANSI SQL operators.
+    """
+    return compile_rule(condition)(user)
+
+
+def _tokenize(condition: str) -> list['Token']:
+    """
+    Split a condition into (kind, value) tokens in a single scan.
+    Kinds are NAME, NUMBER, STRING, NOW, OP and KEYWORD; the list ends with END.
+    The scan works on (pos, end) offsets into the condition; each token value
+    is the only substring it allocates.
+    """
+    tokens: list[Token] = []
+    pos = 0
+    end = len(condition)
+    while end and condition[end - 1].isspace():
+        end -= 1
+    while pos < end:
+        match = _RE_TOKEN.match(condition, pos, end)
+        if match is None:
+            while condition[pos].isspace():
+                pos += 1
+            raise ValueError(f"Invalid condition format: unexpected '{condition[pos]}'")
+        kind = str(match.lastgroup)
+        if kind == 'STRING':
+            # Slice the literal's contents without its quotes in one step
+            value = condition[match.start(kind) + 1:match.end(kind) - 1]
+        elif kind == 'NOW':
+            value = '_now()'
+        else:
+            value = match.group(kind)
+            if kind == 'NAME' and value.upper() in SQL_KEYWORDS:
+                kind, value = 'KEYWORD', value.upper()
+        tokens.append((kind, value))
+        pos = match.end()
+    tokens.append(('END', ''))
+    return tokens
+
+
+def _unexpected(token: 'Token') -> ValueError:
+    """Build the error for a token the parser cannot handle"""
+    if token[0] == 'END':
+        return ValueError("Invalid condition format: unexpected end of condition")
+    return ValueError(f"Invalid condition format: unexpected '{token[1]}'")
+
+
+def _expect(tokens: list['Token'], i: int, kind: str, value: str) -> int:
+    """Consume the token at i if it matches, otherwise raise"""
+    if tokens[i] != (kind, value):
+        raise _unexpected(tokens[i])
+    return i + 1
+
+
+def _parse_or(tokens: list['Token'], i: int) -> tuple['Node', int]:
+    """Parse OR expressions (lowest precedence)"""
+    node, i = _parse_and(tokens, i)
+    children = [node]
+    while tokens[i] == ('KEYWORD', 'OR'):
+        node, i = _parse_and(tokens, i + 1)
+        children.append(node)
+    return (Or(children) if len(children) > 1 else node), i
+
+
+def _parse_and(tokens: list['Token'], i: int) -> tuple['Node', int]:
+    """Parse AND expressions (medium precedence)"""
+    node, i = _parse_not(tokens, i)
+    children = [node]
+    while tokens[i] == ('KEYWORD', 'AND'):
+        node, i = _parse_not(tokens, i + 1)
+        children.append(node)
+    return (And(children) if len(children) > 1 else node), i
+
+
+def _parse_not(tokens: list['Token'], i: int) -> tuple['Node', int]:
+    """Parse NOT expressions (high precedence)"""
+    if tokens[i] == ('KEYWORD', 'NOT'):
+        node, i = _parse_not(tokens, i + 1)
+        return Not(node), i
+    
+    # Parenthesized sub-condition
+    if tokens[i] == ('OP', '('):
+        node, i = _parse_or(tokens, i + 1)
+        return node, _expect(tokens, i, 'OP', ')')
+    
+    return _parse_comparison(tokens, i)
+
+
+def _parse_comparison(tokens: list['Token'], i: int) -> tuple['Node', int]:
+    """Parse comparison expressions and special operators"""
+    kind, field = tokens[i]
+    if kind != 'NAME':
+        raise _unexpected(tokens[i])
+    kind, value = tokens[i + 1]
+    i += 2
+    
+    # Handle BETWEEN
+    if (kind, value) == ('KEYWORD', 'BETWEEN'):
+        lower, i = _parse_arithmetic(tokens, i)
+        i = _expect(tokens, i, 'KEYWORD', 'AND')
+        upper, i = _parse_arithmetic(tokens, i)
+        return Between(field, expression_source(lower), expression_source(upper)), i
+    
+    # Handle IN
+    if (kind, value) == ('KEYWORD', 'IN'):
+        i = _expect(tokens, i, 'OP', '(')
+        values: list[Any] = []
+        while True:
+            # A signed number arrives as a +/- operator token before it
+            sign = ''
+            if tokens[i] in (('OP', '-'), ('OP', '+')) and tokens[i + 1][0] == 'NUMBER':
+                sign = tokens[i][1]
+                i += 1
+            if tokens[i][0] not in ('STRING', 'NUMBER'):
+                raise _unexpected(tokens[i])
+            values.append(sign + tokens[i][1])
+            if tokens[i + 1] != ('OP', ','):
+                break
+            i += 2
+        i = _expect(tokens, i + 1, 'OP', ')')
+        # Convert numeric strings to integers for numeric fields
+        if field in NUMERIC_FIELDS:
+            values = [int(v) for v in values]
+        return In(field, values), i
+    
+    # Handle LIKE
+    if (kind, value) == ('KEYWORD', 'LIKE'):
+        if tokens[i][0] != 'STRING':
+            raise _unexpected(tokens[i])
+        return Like(field, tokens[i][1]), i + 1
+    
+    # Handle standard comparison operators: <=, >=, !=, <>, =, <, >
+    if kind == 'OP' and value in COMPARISON_OPERATORS:
+        if tokens[i][0] == 'STRING':
+            # String value
+            return Cmp(field, value, repr(tokens[i][1])), i + 1
+        # Numeric expression
+        expression, i = _parse_arithmetic(tokens, i)
+        return Cmp(field, value, expression_source(expression)), i
+    
+    raise _unexpected(tokens[i - 1])
+
+
+def _parse_arithmetic(tokens: list['Token'], i: int) -> tuple[str, int]:
+    """
+    Collect the tokens of an arithmetic expression and return its text.
+    Stops at a keyword, a comma or a closing parenthesis it did not open.
+    """
+    parts = []
+    depth = 0
+    while True:
+        kind, value = tokens[i]
+        if kind in ('KEYWORD', 'END', 'STRING') or value == ',':
+            break
+        if value == '(':
+            depth += 1
+        elif value == ')':
+            if depth == 0:
+                break
+            depth -= 1
+        parts.append(value)
+        i += 1
+    if not parts:
+        raise _unexpected(tokens[i])
+    return ' '.join(parts), i
+
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+}
+
+UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+def _parse_expression(expression: str) -> ast.expr:
+    """Parse an arithmetic expression into a Python AST expression node"""
+    expression = str(expression).strip()
+    try:
+        return ast.parse(expression, mode='eval').body
+    except SyntaxError:
+        raise ValueError(f"Invalid expression: {expression}")
+
+
+def _fold_expression(node: ast.expr, now: Optional[int] = None) -> Any:
+    """
+    Fold a whitelisted arithmetic AST into a number.
+    _now() folds to `now` when given, otherwise it is kept as a node and
+    the surrounding expression is folded as far as possible.
+    """
+    if isinstance(node, ast.Constant) and type(node.value) is int:
+        return node.value
+    
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id == '_now' and not node.args and not node.keywords):
+        return node if now is None else now
+    
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        left = _fold_expression(node.left, now)
+        right = _fold_expression(node.right, now)
+        if isinstance(left, ast.AST) or isinstance(right, ast.AST):
+            return ast.BinOp(_as_node(left), node.op, _as_node(right))
+        try:
+            return BINARY_OPERATORS[type(node.op)](left, right)
+        except (ZeroDivisionError, OverflowError) as e:
+            raise ValueError(f"Error evaluating expression '{ast.unparse(node)}': {str(e)}")
+    
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        operand = _fold_expression(node.operand, now)
+        if isinstance(operand, ast.AST):
+            return ast.UnaryOp(node.op, _as_node(operand))
+        return UNARY_OPERATORS[type(node.op)](operand)  # type: ignore[operator]
+    
+    raise ValueError(f"Invalid expression: {ast.unparse(node)}")
+
+
+def _as_node(value: Any) -> ast.expr:
+    """Wrap a folded number back into an AST node"""
+    return value if isinstance(value, ast.expr) else ast.Constant(value)
+
+
+def eval_expression(expression: str) -> int:
+    """
+    Safely evaluate arithmetic expressions.
+    Only allows integers, + - * / //, unary signs and _now(); ** is rejected.
+    """
+    return int(_fold_expression(_parse_expression(expression), _now()))
+
+
+def evaluate_batch(data: Any) -> tuple[int, dict[str, Any]]:
+    """
+    Evaluate the segments of a parsed request body.
+    Returns (status, payload) with payload holding results or an error.
+    """
+    # Read the clock once; every segment sees the same _now()
+    token = _REQUEST_NOW.set(int(time.time()))
+    try:
+        return _evaluate_batch(data)
+    finally:
+        _REQUEST_NOW.reset(token)
+
+
+def _evaluate_batch(data: Any) -> tuple[int, dict[str, Any]]:
+    """Evaluate a request body with the request timestamp already set"""
+    if data is None:
+        return 400, INVALID_JSON
+    
+    # Check required top-level fields
+    if 'user' not in data and 'users' not in data:
+        return 400, MISSING_USER
+    
+    if 'segments' not in data:
+        return 400, MISSING_SEGMENTS
+    
+    segments = data['segments']
+    
+    # Validate the user document, or the batch of user columns
+    try:
+        if 'users' in data:
+            columns = user_columns(data['users'])
+        else:
+            user = data['user']
+            validate_user_document(user)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    
+    # Rules sharing subexpressions are evaluated together. Every rule is
+    # parsed before the plan is built, so an invalid rule skips the plan and
+    # the per-segment loop below reports it against its segment.
+    if 'users' not in data and isinstance(segments, dict) and len(segments) > 1:
+        try:
+            plan = compile_segments(tuple(segments.values()))
+        except Exception:
+            # Invalid syntax, unknown fields, overflowing arithmetic, nesting
+            # too deep or a rule that is not a string
+            plan = None
+        if plan is not None:
+            try:
+                return 200, {"results": dict(zip(segments, plan(user)))}
+            except (ValueError, KeyError, TypeError):
+                # A rule failed on this user's values, e.g. comparing a string
+                # field with a number; the loop below names the failing segment
+                pass
+    
+    # Column batches with many segments run them concurrently; NumPy releases
+    # the GIL inside its kernels. A rule that fails to compile stops the
+    # submissions and is reported by the loop below.
+    pending: dict[str, Future] = {}
+    if 'users' in data and len(segments) >= PARALLEL_SEGMENTS:
+        for segment_name, rule in segments.items():
+            try:
+                # Each task runs in a copy of this context to see the request's _now()
+                pending[segment_name] = _EXECUTOR.submit(
+                    copy_context().run, compile_columns_rule(rule), columns)
+            except Exception:
+                break
+    
+    # Evaluate each segment, stopping at the first failure
+    results: dict[str, Any] = {}
+    try:
+        for segment_name, rule in segments.items():
+            try:
+                if segment_name in pending:
+                    results[segment_name] = pending[segment_name].result().tolist()
+                elif 'users' in data:
+                    results[segment_name] = compile_columns_rule(rule)(columns).tolist()
+                else:
+                    results[segment_name] = compile_rule(rule)(user)
+            except ValueError as e:
+                # Invalid SQL or unknown field
+                return 400, {"error": f"Error in segment '{segment_name}': {str(e)}"}
+            except KeyError as e:
+                # Field not found in user data (shouldn't happen after validation)
+                return 400, {"error": f"Field {str(e)} not found in user document"}
+            except Exception as e:
+                # Any other error
+                return 400, {"error": f"Error evaluating segment '{segment_name}': {str(e)}"}
+    finally:
+        # Column tasks that have not started yet are not needed after a failure
+        for future in pending.values():
+            future.cancel()
+    
+    return 200, {"results": results}
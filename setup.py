@@ -0,0 +1,13 @@
+"""
+Optional native build of the rule engine with mypyc:
+    pip install mypy && python setup.py build_ext --inplace
+server.py imports the compiled server_core extension when it is present.
+"""
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name='user-segmentation-server',
+    py_modules=['server'],
+    ext_modules=mypycify(['server_core.py']),
+)